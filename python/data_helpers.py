@@ -118,3 +118,17 @@ def batch_iter(data, batch_size, num_epochs):
             start_index = batch_num * batch_size
             end_index = min((batch_num + 1) * batch_size, data_size)
             yield shuffled_data[start_index:end_index]
+
+
+def batch_generator(x, y, indices, batch_size):
+    """
+    Generates an endless stream of (x, y) batches for Keras fit_generator.
+    Batches are gathered through the given indices, which are reshuffled
+    every epoch, so the full data set is never copied.
+    """
+    indices = np.array(indices)
+    while True:
+        np.random.shuffle(indices)
+        for start_index in range(0, len(indices), batch_size):
+            batch_indices = indices[start_index:start_index + batch_size]
+            yield x[batch_indices], y[batch_indices]
@@ -35,26 +35,53 @@ than the one introduced in the original article:
 Training Word2Vec on the same "Movie reviews" data set is enough to 
 achieve performance reported in the article (81.6%)
 
-** Another distinct difference is slidind MaxPooling window of length=2
-instead of MaxPooling over whole feature map as in the article
+** MaxPooling is taken over the whole feature map as in the article
+(the results above were obtained with a sliding MaxPooling window of length=2)
 """
 
 import numpy as np
 import data_helpers
-from w2v import train_word2vec
+import os
+import sys
+
+# let cuDNN pick its Winograd kernels for the small filter sizes below; this
+# has to be set before the TensorFlow backend is loaded by keras
+os.environ.setdefault('TF_ENABLE_WINOGRAD_NONFUSED', '1')
 
-from keras.models import Sequential, Model
-from keras.layers import Activation, Dense, Dropout, Embedding, Flatten, Input, Merge, Convolution1D, MaxPooling1D
+import keras
+from keras.models import Model
+from keras.layers import Activation, Dense, Dropout, Embedding, Input, merge, Convolution1D, GlobalMaxPooling1D
 from keras.models import model_from_json
+from keras.optimizers import RMSprop
+from keras import backend as K
+try:
+    from keras.utils import multi_gpu_model
+except ImportError:
+    # only shipped with Keras >= 2.0.9, fall back to single device training
+    multi_gpu_model = None
 from sklearn.metrics import confusion_matrix
-import matplotlib.pyplot as plt
 from sklearn import metrics
-import os
-from gensim.models import word2vec
+import json
 
 classes = ['0','1']
 
-def plot_confusion_matrix(cm, title='Confusion matrix', cmap=plt.cm.jet):
+def get_pyplot():
+    """
+    Imports pyplot on first use, so training runs never pay for backend
+    detection. Falls back to the headless Agg backend on Linux without X.
+    """
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        if sys.platform.startswith('linux') and not os.environ.get('DISPLAY'):
+            matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def plot_confusion_matrix(cm, title='Confusion matrix', cmap=None):
+    plt = get_pyplot()
+    if cmap is None:
+        cmap = plt.cm.jet
     plt.figure()
     plt.imshow(cm, interpolation='nearest', cmap=cmap)
     plt.title(title, weight='bold')
@@ -78,17 +105,53 @@ def show_confusion_matrix(l_test, predicted):
 
     # Normalize the confusion matrix by row (i.e by the number of samples
     # in each class)
-    cm_normalized = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
+    cm_normalized = cm.astype(np.float32) / cm.sum(axis=1, keepdims=True, dtype=np.float32)
     # print('Safety Success - Normalized confusion matrix')
     print(cm_normalized)
     plot_confusion_matrix(cm_normalized)
-    plt.show()
+    get_pyplot().show()
+
+
+def clipped_binary_crossentropy(y_true, y_pred):
+    """
+    Binary crossentropy clipped at the current K.epsilon(). The backend
+    version clips at the epsilon it saw on import (1e-7), and 1 - 1e-7
+    rounds to 1 in float16, so log(1 - y_pred) turns into log(0).
+    """
+    y_pred = K.clip(y_pred, K.epsilon(), 1. - K.epsilon())
+    return -K.mean(y_true * K.log(y_pred) + (1. - y_true) * K.log(1. - y_pred), axis=-1)
+
+
+def count_gpus():
+    """
+    Returns the number of GPUs visible to the TensorFlow backend.
+    """
+    if K.backend() != 'tensorflow':
+        return 0
+    from tensorflow.python.client import device_lib
+    return len([d for d in device_lib.list_local_devices() if d.device_type == 'GPU'])
+
+
+_MODEL_CACHE = {}
+
+def load_network(architecture, weights):
+    """
+    Builds the model from its JSON architecture and loads its weights.
+    Models are cached by (architecture, weights), so repeated scoring
+    skips the JSON parsing and HDF5 reads.
+    """
+    key = (architecture, weights)
+    if key not in _MODEL_CACHE:
+        model = model_from_json(open(architecture).read())
+        model.load_weights(weights)
+        _MODEL_CACHE[key] = model
+    return _MODEL_CACHE[key]
 
 
 def test_network(architecture, weights, data):
-    model = model_from_json(open(architecture).read())
-    model.load_weights(weights)
-    pred = model.predict_classes(data, batch_size=1)
+    model = load_network(architecture, weights)
+    # functional models have no predict_classes, threshold the sigmoid output
+    pred = (model.predict(data, batch_size=256) > 0.5).astype('int32')
     # score = model.predict_proba(data, batch_size=1)
     return pred
 
@@ -118,6 +181,8 @@ if training == True:
     batch_size = 32
     num_epochs = 7
     val_split = 0.1
+    prefetch_batches = 32  # batches gathered ahead of the training step
+    float_precision = 'float32'  # 'float16' halves activation memory on GPUs with fast fp16
 
     # Word2Vec parameters, see train_word2vec
     min_word_count = 1  # Minimum word count
@@ -133,19 +198,29 @@ if training == True:
 
     x, y, vocabulary, vocabulary_inv = data_helpers.load_data(pos_train_path,neg_train_path)
 
+    # sentences are padded to the same length, so it is the matrix width
+    assert x.ndim == 2
+    sequence_length = x.shape[1]
+
     if model_variation=='CNN-non-static' or model_variation=='CNN-static':
+        # imported here so that CNN-rand never loads gensim
+        from w2v import train_word2vec
         embedding_weights = train_word2vec(x, vocabulary_inv, model_variation, embedding_dim, min_word_count, context)
-        if model_variation=='CNN-static':
-            x = embedding_weights[0][x]
     elif model_variation=='CNN-rand':
         embedding_weights = None
     else:
         raise ValueError('Unknown model variation')
 
     # Shuffle data
+    # only the indices are permuted, batches are gathered from x lazily
     shuffle_indices = np.random.permutation(np.arange(len(y)))
-    x_shuffled = x[shuffle_indices]
-    y_shuffled = y[shuffle_indices].argmax(axis=1)
+    # labels are 0/1, store them as single bytes
+    y = y.argmax(axis=1).astype(np.uint8)
+
+    # hold out the tail of the shuffled indices for validation
+    split_at = int(len(shuffle_indices) * (1. - val_split))
+    train_indices = shuffle_indices[:split_at]
+    val_indices = shuffle_indices[split_at:]
 
 
 
@@ -154,52 +229,83 @@ if training == True:
     # Building model
     # ==================================================
     #
-    # graph subnet with one input and one output,
+    # single functional model: embedding and input dropout feed
     # convolutional layers concateneted in parallel
 
-    # make sequence length variable depending on data formatting
-    sequence_length = max(len(x) for x in x_shuffled)
-
-    graph_in = Input(shape=(sequence_length, embedding_dim))
+    loss = 'binary_crossentropy'
+    optimizer = 'rmsprop'
+    if float_precision == 'float16':
+        # this Keras has no mixed precision policy, so the whole graph runs
+        # in half precision; the fuzz factors must stay representable in it:
+        # RMSprop's default 1e-8 flushes to 0 (0/0 updates for zero gradients)
+        # and 1 - 1e-4 still rounds to 1, so the loss clips at 1e-3
+        K.set_floatx('float16')
+        K.set_epsilon(1e-3)
+        loss = clipped_binary_crossentropy
+        optimizer = RMSprop(epsilon=1e-4)
+
+    model_input = Input(shape=(sequence_length,), dtype='int32')
+    # CNN-static keeps the Word2Vec vectors frozen inside the Embedding layer,
+    # so the input stays int indices instead of a float (N, L, D) tensor
+    z = Embedding(len(vocabulary), embedding_dim, input_length=sequence_length,
+                  weights=embedding_weights, trainable=(model_variation!='CNN-static'))(model_input)
+    z = Dropout(dropout_prob[0])(z)
+
+    # Convolution1D always runs channels-last on (batch, steps, embedding_dim),
+    # which is exactly the Embedding output, so no permute is needed here
     convs = []
     for fsz in filter_sizes:
         conv = Convolution1D(nb_filter=num_filters,
                              filter_length=fsz,
                              border_mode='valid',
                              activation='relu',
-                             subsample_length=1)(graph_in)
-        pool = MaxPooling1D(pool_length=2)(conv)
-        flatten = Flatten()(pool)
-        convs.append(flatten)
+                             subsample_length=1)(z)
+        # one max per filter, so Dense(hidden_dims) sees len(filter_sizes) * num_filters inputs
+        pool = GlobalMaxPooling1D()(conv)
+        convs.append(pool)
 
-    if len(filter_sizes)>1:
-        out = Merge(mode='concat')(convs)
-    else:
-        out = convs[0]
-
-    graph = Model(input=graph_in, output=out)
-
-    # main sequential model
-    model = Sequential()
-    if not model_variation=='CNN-static':
-        model.add(Embedding(len(vocabulary), embedding_dim, input_length=sequence_length,
-                            weights=embedding_weights))
-    model.add(Dropout(dropout_prob[0], input_shape=(sequence_length, embedding_dim)))
-    model.add(graph)
-    model.add(Dense(hidden_dims))
-    model.add(Dropout(dropout_prob[1]))
-    model.add(Activation('relu'))
-    model.add(Dense(1))
-    model.add(Activation('sigmoid'))
-    model.compile(loss='binary_crossentropy', optimizer='rmsprop', metrics=['accuracy'])
+    z = merge(convs, mode='concat', concat_axis=-1) if len(convs)>1 else convs[0]
+
+    z = Dense(hidden_dims)(z)
+    z = Dropout(dropout_prob[1])(z)
+    z = Activation('relu')(z)
+    z = Dense(1)(z)
+    model_output = Activation('sigmoid')(z)
+
+    model = Model(input=model_input, output=model_output)
+    model.compile(loss=loss, optimizer=optimizer, metrics=['accuracy'])
 
     json_string = model.to_json()
     open('imdb_'+ model_variation +'7_arch.json', 'w').write(json_string)
+    json.dump(vocabulary_inv, open('imdb_'+ model_variation +'7_vocab.json', 'w'))
 
     # Training model
     # ==================================================
-    model.fit(x_shuffled, y_shuffled, batch_size=batch_size,
-              nb_epoch=num_epochs, validation_split=val_split, verbose=2)
+    # replicate the model on every GPU and split each batch between them;
+    # weights are shared with the template model, which is the one saved
+    gpus = count_gpus() if multi_gpu_model is not None else 0
+    if gpus > 1:
+        print('Training on %d GPUs' % gpus)
+        train_model = multi_gpu_model(model, gpus=gpus)
+        train_model.compile(loss=loss, optimizer=optimizer, metrics=['accuracy'])
+        batch_size *= gpus
+    else:
+        train_model = model
+
+    # an epoch is one pass of batch_generator over train_indices, which ends
+    # with a partial batch; Keras 1 counts it in samples, Keras 2 in batches
+    # (where the legacy samples_per_epoch would be taken as a batch count)
+    steps_per_epoch = int(np.ceil(len(train_indices) / float(batch_size)))
+    if keras.__version__.startswith('1.'):
+        epoch_args = dict(samples_per_epoch=len(train_indices), nb_epoch=num_epochs,
+                          max_q_size=prefetch_batches)
+    else:
+        epoch_args = dict(steps_per_epoch=steps_per_epoch, epochs=num_epochs,
+                          max_queue_size=prefetch_batches)
+
+    train_model.fit_generator(data_helpers.batch_generator(x, y, train_indices, batch_size),
+                              validation_data=(x[val_indices], y[val_indices]),
+                              verbose=2, **epoch_args)
 
     model_name = 'imdb_' + model_variation + str(num_epochs) + '.h5'
     model.save_weights(model_name)
@@ -223,43 +329,24 @@ else:
     dropout_prob = (0.7, 0.8)
     hidden_dims = 100
 
-    # Word2Vec parameters, see train_word2vec
-    min_word_count = 1  # Minimum word count
-    context = 10  # Context window size
-
-
-    model_dir = 'word2vec_models'
-    model_name = "{:d}features_{:d}minwords_{:d}context_{:s}".format(embedding_dim, min_word_count, context,
-                                                                     model_variation)
-    print ("Loading word2vec model: " + model_name)
-    model_name = os.path.join(model_dir, model_name)
-    eb = word2vec.Word2Vec.load(model_name)
+    print ("Loading vocabulary")
+    vocabulary_inv = json.load(open('imdb_' + model_variation + '7_vocab.json'))
+    vocabulary = {w: i for i, w in enumerate(vocabulary_inv)}
+    pad_idx = vocabulary['<PAD/>']
 
     print ("Loading CNN")
     arch = 'imdb_' + model_variation + '7_arch.json'
     weights = 'imdb_' + model_variation + '7.h5'
-    model = model_from_json(open(arch).read())
-    model.load_weights(weights)
+    model = load_network(arch, weights)
 
     print ("padding senetences")
     pad_size = model.input_shape[1]
     sentences = data_helpers.pad_sentences(sentences, sequence_length=pad_size)
 
-    x = []
-    sentence = sentences[0]
-    for word in sentence:
-        try:
-            vect = eb[word]
-        except:
-            vect = eb['<PAD/>']
-        x.append(vect)
-
-    x = np.asarray(x)
-    pred = model.predict_classes(x, batch_size=1)
-    print pred
-    # for sentence in sentences:
-    #     temp = []
-    #     for sentense
+    # map every word to its training vocabulary index, unknown words fall back to padding
+    x = np.array([[vocabulary.get(word, pad_idx) for word in sentence[:pad_size]]
+                  for sentence in sentences], dtype=np.int32)
+    pred = test_network(arch, weights, x)
 
 
     # pred = model.predict_classes(data, batch_size=1)
@@ -275,7 +362,7 @@ else:
 
     # pred = test_network('imdb_CNN-rand7_arch.json', 'imdb_CNN-rand7.h5',x_shuffled[0:test_num])
 
-    l = y_shuffled[0:test_num]
+    l = labels.argmax(axis=1)
 
     confusion_matrix(l, pred)
 
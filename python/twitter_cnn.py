@@ -75,7 +75,7 @@ def show_confusion_matrix(l_test, predicted):
 
     # Normalize the confusion matrix by row (i.e by the number of samples
     # in each class)
-    cm_normalized = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
+    cm_normalized = cm.astype(np.float32) / cm.sum(axis=1, keepdims=True, dtype=np.float32)
     # print('Safety Success - Normalized confusion matrix')
     print(cm_normalized)
     plot_confusion_matrix(cm_normalized)
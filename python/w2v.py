@@ -45,9 +45,12 @@ def train_word2vec(sentence_matrix, vocabulary_inv, model_variation,
         embedding_model.save(model_name)
     
     #  add unknown words
-    embedding_weights = [np.array([embedding_model[w] if w in embedding_model\
+    vocab = embedding_model.vocab
+    vectors = embedding_model.syn0
+    #  random rows are float64, force float32 so the stack is not upcast
+    embedding_weights = [np.asarray([vectors[vocab[w].index] if w in vocab\
                                                         else np.random.uniform(-0.25,0.25,embedding_model.vector_size)\
-                                                        for w in vocabulary_inv])]
+                                                        for w in vocabulary_inv], dtype=np.float32)]
     return embedding_weights
 
 def get_word_embeddings():